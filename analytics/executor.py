@@ -2,14 +2,52 @@
 Исполнитель SQL запросов к базе данных.
 """
 import logging
-from typing import Optional
+import traceback
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
+
+import asyncpg
 
-from db.database import get_pool
 from analytics.query_builder import QueryBuilder
+from db.database import get_pool
 from nl.schemas import QueryRequest
 
 logger = logging.getLogger(__name__)
 
+# Соединение, закрепленное за текущей задачей через with_connection()
+_connection: ContextVar[Optional[asyncpg.Connection]] = ContextVar("db_conn", default=None)
+
+
+@asynccontextmanager
+async def with_connection() -> AsyncIterator[asyncpg.Connection]:
+    """
+    Закрепляет одно соединение пула за текущей задачей.
+
+    Внутри блока все вызовы QueryExecutor.execute_query используют это
+    соединение напрямую, без повторных pool.acquire()/release().
+    Нужно для обработчиков, выполняющих несколько запросов подряд.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        token = _connection.set(conn)
+        try:
+            yield conn
+        finally:
+            _connection.reset(token)
+
+
+async def _fetchval(sql: str, params: list):
+    """Выполняет запрос на закрепленном соединении или на соединении из пула."""
+    conn = _connection.get()
+    if conn is not None:
+        # Соединение уже закреплено за задачей (with_connection)
+        return await conn.fetchval(sql, *params)
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval(sql, *params)
+
 
 class QueryExecutor:
     """Исполнитель запросов к базе данных."""
@@ -30,29 +68,35 @@ class QueryExecutor:
         try:
             # Строим SQL запрос
             sql, params = QueryBuilder.build_sql(query)
-            logger.debug(f"Сгенерированный SQL: {sql}")
-            logger.debug(f"Параметры SQL: {params}")
-
-            # Получаем пул соединений
-            pool = await get_pool()
+            logger.debug("Сгенерированный SQL: %s", sql)
+            logger.debug("Параметры SQL: %s", params)
 
-            # Выполняем запрос
-            async with pool.acquire() as conn:
-                result = await conn.fetchval(sql, *params)
-                logger.debug(f"Результат запроса: {result}")
+            try:
+                result = await _fetchval(sql, params)
+            except asyncpg.UndefinedTableError as e:
+                if not QueryBuilder.disable_mv_routing(e):
+                    raise
+                logger.warning(
+                    "Витрины нет в БД, запросы идут по базовым таблицам "
+                    "(примените db/schema.sql повторно): %s", e
+                )
+                sql, params = QueryBuilder.build_sql(query)
+                result = await _fetchval(sql, params)
+            logger.debug("Результат запроса: %s", result)
 
-                # Преобразуем результат в int (может быть None, Decimal и т.д.)
-                if result is None:
-                    return 0
+            # COUNT и SUM по integer возвращают bigint, NUMERIC декодируется
+            # в int кодеком пула, поэтому приводить нужно только пустой результат
+            if result is None:
+                return 0
 
-                return int(result)
+            return result if type(result) is int else int(result)
 
         except Exception as e:
-            logger.error(f"Ошибка при выполнении SQL запроса: {e}")
+            logger.error("Ошибка при выполнении SQL запроса: %s", e)
             if sql:
-                logger.debug(f"SQL: {sql}")
+                logger.debug("SQL: %s", sql)
             if params:
-                logger.debug(f"Params: {params}")
-            import traceback
-            logger.debug(traceback.format_exc())
+                logger.debug("Params: %s", params)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(traceback.format_exc())
             return None
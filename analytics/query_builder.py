@@ -1,9 +1,87 @@
 """
 Построитель SQL запросов из структурированных запросов.
 """
-from datetime import date, datetime
+import re
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 from typing import Optional
-from nl.schemas import QueryRequest, MetricType
+from nl.schemas import QueryRequest, MetricType, TableType
+
+# Дата YYYY-MM-DD; "T" или пробел после нее означает, что дальше идет время
+# в любом виде, который принимает datetime.fromisoformat ("T10", "T10:30", ...)
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}([T ])?")
+# Форматы для значений вне _DATE_RE (strptime допускает числа без ведущих нулей)
+_FALLBACK_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+# Предагрегированная витрина videos по (creator_id, день публикации)
+_MV_TABLE = "mv_video_daily_agg"
+# Направлять ли запросы в витрину (отключается, если ее нет в БД)
+_mv_enabled = True
+
+# Поле метрики -> колонка с суммой в витрине
+_MV_SUM_COLUMNS = {
+    "views_count": "s_views",
+    "likes_count": "s_likes",
+    "comments_count": "s_comments",
+    "reports_count": "s_reports",
+}
+
+# Виды фильтра по дате, которые выражаются через день публикации
+_MV_DATE_MODES = frozenset(("exact_date", "range_date", "start_date", "end_date"))
+
+
+# Преобразуем enum в реальное имя таблицы в БД
+_TABLE_NAME_MAP = {
+    "videos": "videos",
+    "snapshots": "video_snapshots"
+}
+
+# Специальные значения metric_field для подсчета уникальных дат -> поле с датой
+_DATE_METRIC_FIELDS = {
+    "video_created_at_date": "video_created_at",
+    "created_at_date": "created_at",
+}
+
+
+def _select_count(metric_field: Optional[str], table_name: Optional[str]) -> str:
+    return "SELECT COUNT(*)"
+
+
+def _select_sum(metric_field: Optional[str], table_name: Optional[str]) -> str:
+    if not metric_field:
+        raise ValueError("metric_field обязателен для SUM")
+    field = metric_field
+    # Для JOIN нужно указывать полное имя таблицы
+    if table_name:
+        field = f"{table_name}.{field}"
+    return f"SELECT SUM({field})"
+
+
+def _select_distinct(metric_field: Optional[str], table_name: Optional[str]) -> str:
+    if not metric_field:
+        raise ValueError("metric_field обязателен для DISTINCT_COUNT")
+
+    # Специальная обработка для подсчета уникальных дат
+    date_field = _DATE_METRIC_FIELDS.get(metric_field)
+    if date_field:
+        if table_name:
+            date_field = f"{table_name}.{date_field}"
+        return f"SELECT COUNT(DISTINCT DATE({date_field}))"
+
+    # Обычное поле
+    # Для JOIN нужно указывать полное имя таблицы
+    field = metric_field
+    if table_name:
+        field = f"{table_name}.{field}"
+    return f"SELECT COUNT(DISTINCT {field})"
+
+
+# Тип метрики -> построитель SELECT части
+_SELECT_BUILDERS = {
+    MetricType.COUNT: _select_count,
+    MetricType.SUM: _select_sum,
+    MetricType.DISTINCT_COUNT: _select_distinct,
+}
 
 
 class QueryBuilder:
@@ -14,132 +92,96 @@ class QueryBuilder:
         """
         Строит SQL запрос на основе QueryRequest.
 
+        Текст запроса зависит только от "формы" запроса (таблица, метрика,
+        набор фильтров), поэтому он кешируется в _build_sql_template,
+        а значения параметров собираются при каждом вызове.
+
         Args:
             query: Структурированный запрос
 
         Returns:
             Кортеж (SQL запрос, список параметров)
         """
-        # Преобразуем enum в реальное имя таблицы в БД
-        table_name_map = {
-            "videos": "videos",
-            "snapshots": "video_snapshots"
-        }
-        table_name = table_name_map[query.table.value]
-
-        # Определяем WHERE часть
-        where_parts = []
         params = []
-        param_index = 1
-
-        # Проверяем, нужен ли JOIN для фильтрации по creator_id в snapshots
-        needs_join = query.creator_id_filter and table_name == "video_snapshots"
-
-        # Определяем SELECT часть (для JOIN нужно указывать полное имя таблицы)
-        select_table = table_name if needs_join else None
-        select_part = QueryBuilder._build_select(query, select_table)
-
-        # Определяем FROM часть (с JOIN если нужно)
-        if needs_join:
-            from_part = f"FROM {table_name} INNER JOIN videos ON {table_name}.video_id = videos.id"
-        else:
-            from_part = f"FROM {table_name}"
 
         # Фильтр по дате
+        date_field = None
+        date_mode = None
         if query.date_filter:
-            # Для JOIN нужно указывать полное имя таблицы
-            date_field = f"{table_name}.{query.date_filter.field}" if needs_join else query.date_filter.field
-            date_filter_with_table = type(query.date_filter)(
-                field=date_field,
-                start_date=query.date_filter.start_date,
-                end_date=query.date_filter.end_date,
-                exact_date=query.date_filter.exact_date
-            )
-            date_where, date_params, param_index = QueryBuilder._build_date_filter(
-                date_filter_with_table, param_index
-            )
-            where_parts.append(date_where)
-            params.extend(date_params)
+            date_field = query.date_filter.field
+            date_mode = QueryBuilder._build_date_params(query.date_filter, params)
 
         # Фильтр по creator_id
-        if needs_join:
-            # Для таблицы snapshots используем JOIN
-            where_parts.append(f"videos.creator_id = ${param_index}")
-            params.append(query.creator_id_filter)
-            param_index += 1
-        elif query.creator_id_filter:
-            # Для таблицы videos фильтр по creator_id напрямую
-            where_parts.append(f"creator_id = ${param_index}")
+        has_creator = bool(query.creator_id_filter)
+        if has_creator:
             params.append(query.creator_id_filter)
-            param_index += 1
 
         # Фильтр сравнения
+        comparison_field = None
+        comparison_op = None
         if query.comparison_filter:
-            # Для JOIN нужно указывать полное имя таблицы
-            comp_field = query.comparison_filter.field.value
-            if needs_join:
-                comp_field = f"{table_name}.{comp_field}"
-            comp_where, comp_params, param_index = QueryBuilder._build_comparison_filter(
-                query.comparison_filter, param_index, comp_field
-            )
-            where_parts.append(comp_where)
-            params.extend(comp_params)
-
-        # Собираем WHERE
-        where_part = ""
-        if where_parts:
-            where_part = "WHERE " + " AND ".join(where_parts)
-
-        # Собираем полный запрос
-        sql = f"{select_part}\n{from_part}\n{where_part}"
-
-        return sql, params
+            # Оператор уже проверен pydantic (ComparisonOperator)
+            comparison_op = query.comparison_filter.operator.value
+            comparison_field = query.comparison_filter.field.value
+            params.append(query.comparison_filter.value)
+
+        # Проверяем, нужен ли JOIN для фильтрации по creator_id в snapshots
+        needs_join = has_creator and query.table == TableType.SNAPSHOTS
+
+        shape = (
+            query.table.value,
+            query.metric_type,
+            query.metric_field.value if query.metric_field else None,
+            date_field,
+            date_mode,
+            has_creator,
+            comparison_field,
+            comparison_op,
+            needs_join,
+        )
+        return _build_sql_template(shape), params
+
+    @staticmethod
+    def disable_mv_routing(error: Exception) -> bool:
+        """
+        Отключает чтение из витрины, если ошибка говорит о том, что ее нет в БД.
+
+        Витрина создается schema.sql, а на базе, созданной до ее появления,
+        ее может не быть, пока схему не применят повторно.
+
+        Args:
+            error: Ошибка выполнения запроса
+
+        Returns:
+            True, если ошибка относится к витрине и запрос стоит построить
+            заново (в том числе когда витрину уже отключил параллельный запрос)
+        """
+        global _mv_enabled
+        if _MV_TABLE not in str(error):
+            return False
+        if _mv_enabled:
+            _mv_enabled = False
+            _build_sql_template.cache_clear()
+        return True
 
     @staticmethod
-    def _build_select(query: QueryRequest, table_name: Optional[str] = None) -> str:
+    def _build_select(
+        metric_type: MetricType,
+        metric_field: Optional[str],
+        table_name: Optional[str] = None
+    ) -> str:
         """
         Строит SELECT часть запроса.
         
         Args:
-            query: Запрос
+            metric_type: Тип метрики
+            metric_field: Поле метрики
             table_name: Имя таблицы (для JOIN нужно указывать полное имя)
         """
-        metric_type = query.metric_type
-
-        if metric_type == MetricType.COUNT:
-            return "SELECT COUNT(*)"
-        elif metric_type == MetricType.SUM:
-            if not query.metric_field:
-                raise ValueError("metric_field обязателен для SUM")
-            field = query.metric_field.value
-            # Для JOIN нужно указывать полное имя таблицы
-            if table_name:
-                field = f"{table_name}.{field}"
-            return f"SELECT SUM({field})"
-        elif metric_type == MetricType.DISTINCT_COUNT:
-            if not query.metric_field:
-                raise ValueError("metric_field обязателен для DISTINCT_COUNT")
-            field = query.metric_field.value
-            
-            # Специальная обработка для подсчета уникальных дат
-            if field == "video_created_at_date":
-                field = "video_created_at"
-                if table_name:
-                    field = f"{table_name}.{field}"
-                return f"SELECT COUNT(DISTINCT DATE({field}))"
-            elif field == "created_at_date":
-                field = "created_at"
-                if table_name:
-                    field = f"{table_name}.{field}"
-                return f"SELECT COUNT(DISTINCT DATE({field}))"
-            
-            # Обычное поле
-            # Для JOIN нужно указывать полное имя таблицы
-            if table_name:
-                field = f"{table_name}.{field}"
-            return f"SELECT COUNT(DISTINCT {field})"
-        else:
+        builder = _SELECT_BUILDERS.get(metric_type)
+        if builder is None:
             raise ValueError(f"Неизвестный тип метрики: {metric_type}")
+        return builder(metric_field, table_name)
 
     @staticmethod
     def _parse_date_or_datetime(date_str: str):
@@ -154,50 +196,33 @@ class QueryBuilder:
         """
         if isinstance(date_str, (date, datetime)):
             return date_str
-        
-        try:
-            # Пробуем парсить как datetime (с временем)
-            if 'T' in date_str or ' ' in date_str:
-                return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-            else:
-                # Только дата
-                return date.fromisoformat(date_str)
-        except ValueError:
-            # Если не получилось, пробуем разные форматы
-            for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
-                try:
-                    return datetime.strptime(date_str, fmt)
-                except ValueError:
-                    continue
-            raise ValueError(f"Не удалось распарсить дату: {date_str}")
+
+        return _parse_date_str(date_str)
 
     @staticmethod
-    def _build_date_filter(date_filter, param_index: int) -> tuple[str, list, int]:
+    def _build_date_params(date_filter, params: list) -> str:
         """
-        Строит WHERE условие для фильтра по дате.
+        Определяет вид фильтра по дате и дописывает его параметры в params.
+
+        Args:
+            date_filter: Фильтр по дате
+            params: Список параметров запроса (дополняется на месте)
 
         Returns:
-            (WHERE условие, список параметров, новый param_index)
+            Вид фильтра
         """
-        field = date_filter.field
-        params = []
-
         if date_filter.exact_date:
             # Точная дата
             date_obj = QueryBuilder._parse_date_or_datetime(date_filter.exact_date)
             if isinstance(date_obj, datetime):
-                # Если есть время, используем прямое сравнение (точное время)
-                where = f"{field} >= ${param_index} AND {field} < ${param_index + 1}"
                 # Добавляем начало и конец дня для точной даты
                 start_dt = date_obj.replace(hour=0, minute=0, second=0, microsecond=0)
-                end_dt = start_dt.replace(day=start_dt.day + 1)
-                params.extend([start_dt, end_dt])
-                param_index += 2
-            else:
-                # Только дата, используем DATE()
-                where = f"DATE({field}) = ${param_index}"
-                params.append(date_obj)
-                param_index += 1
+                end_dt = start_dt + timedelta(days=1)
+                params.extend((start_dt, end_dt))
+                return "exact_datetime"
+            # Полуинтервал [день, следующий день)
+            params.extend((date_obj, date_obj + timedelta(days=1)))
+            return "exact_date"
         elif date_filter.start_date and date_filter.end_date:
             # Диапазон дат/времени
             start_obj = QueryBuilder._parse_date_or_datetime(date_filter.start_date)
@@ -211,65 +236,240 @@ class QueryBuilder:
                 if isinstance(end_obj, date) and not isinstance(end_obj, datetime):
                     # Для конечной даты добавляем конец дня, если время не указано
                     end_obj = datetime.combine(end_obj, datetime.max.time())
-                
-                where = f"{field} >= ${param_index} AND {field} <= ${param_index + 1}"
-                params.extend([start_obj, end_obj])
-                param_index += 2
-            else:
-                # Только даты, используем DATE()
-                where = f"DATE({field}) >= ${param_index} AND DATE({field}) <= ${param_index + 1}"
-                params.extend([start_obj, end_obj])
-                param_index += 2
+                params.extend((start_obj, end_obj))
+                return "range_datetime"
+            # Полуинтервал [начало, день после конца), конец включительно
+            params.extend((start_obj, end_obj + timedelta(days=1)))
+            return "range_date"
         elif date_filter.start_date:
             # Только начальная дата
             date_obj = QueryBuilder._parse_date_or_datetime(date_filter.start_date)
-            if isinstance(date_obj, datetime):
-                where = f"{field} >= ${param_index}"
-            else:
-                where = f"DATE({field}) >= ${param_index}"
             params.append(date_obj)
-            param_index += 1
+            if isinstance(date_obj, datetime):
+                return "start_datetime"
+            return "start_date"
         elif date_filter.end_date:
             # Только конечная дата
             date_obj = QueryBuilder._parse_date_or_datetime(date_filter.end_date)
             if isinstance(date_obj, datetime):
                 # Для datetime с временем используем <=, для конца дня добавляем время
-                if isinstance(date_obj, datetime) and date_obj.hour == 0 and date_obj.minute == 0:
+                if date_obj.hour == 0 and date_obj.minute == 0:
                     date_obj = date_obj.replace(hour=23, minute=59, second=59)
-                where = f"{field} <= ${param_index}"
-            else:
-                where = f"DATE({field}) <= ${param_index}"
-            params.append(date_obj)
-            param_index += 1
+                params.append(date_obj)
+                return "end_datetime"
+            # Все моменты до начала следующего дня
+            params.append(date_obj + timedelta(days=1))
+            return "end_date"
         else:
             raise ValueError("date_filter должен содержать хотя бы одну дату")
 
-        return where, params, param_index
-
     @staticmethod
-    def _build_comparison_filter(comparison_filter, param_index: int, field_override: Optional[str] = None) -> tuple[str, list, int]:
+    def _build_date_filter(field: str, date_mode: str, param_index: int) -> tuple[str, int]:
         """
-        Строит WHERE условие для фильтра сравнения.
+        Строит WHERE условие для фильтра по дате.
+
+        Колонка не оборачивается в DATE(), чтобы условие оставалось
+        диапазоном по исходному полю и планировщик мог использовать btree индекс.
+        Границы дней передаются параметрами (см. _build_date_params).
 
         Args:
-            comparison_filter: Фильтр сравнения
+            field: Поле для фильтрации
+            date_mode: Вид фильтра (см. _build_date_params)
             param_index: Индекс параметра
-            field_override: Переопределение поля (для JOIN)
 
         Returns:
-            (WHERE условие, список параметров, новый param_index)
+            (WHERE условие, новый param_index)
         """
-        field = field_override if field_override else comparison_filter.field.value
-        operator = comparison_filter.operator
-        value = comparison_filter.value
+        if date_mode == "exact_datetime":
+            # Если есть время, используем прямое сравнение (точное время)
+            where = f"{field} >= ${param_index} AND {field} < ${param_index + 1}"
+            return where, param_index + 2
+        elif date_mode == "exact_date":
+            where = f"{field} >= ${param_index} AND {field} < ${param_index + 1}"
+            return where, param_index + 2
+        elif date_mode == "range_datetime":
+            where = f"{field} >= ${param_index} AND {field} <= ${param_index + 1}"
+            return where, param_index + 2
+        elif date_mode == "range_date":
+            where = f"{field} >= ${param_index} AND {field} < ${param_index + 1}"
+            return where, param_index + 2
+        elif date_mode == "start_datetime":
+            return f"{field} >= ${param_index}", param_index + 1
+        elif date_mode == "start_date":
+            return f"{field} >= ${param_index}", param_index + 1
+        elif date_mode == "end_datetime":
+            return f"{field} <= ${param_index}", param_index + 1
+        elif date_mode == "end_date":
+            return f"{field} < ${param_index}", param_index + 1
+        else:
+            raise ValueError(f"Неизвестный вид фильтра по дате: {date_mode}")
+
+
+@lru_cache(maxsize=1024)
+def _parse_date_str(date_str: str):
+    """
+    Парсит строку даты/времени (см. QueryBuilder._parse_date_or_datetime).
+
+    Обычный вид значения определяется одним совпадением регулярного
+    выражения, без перебора форматов через исключения; остальные значения
+    разбирает _parse_date_fallback. Результат кешируется: границы
+    периодов в запросах часто повторяются.
+    """
+    match = _DATE_RE.match(date_str)
+    if match:
+        try:
+            if match.group(1):
+                # Дата с временем
+                return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+            # Только дата
+            return date.fromisoformat(date_str)
+        except ValueError:
+            pass
+    return _parse_date_fallback(date_str)
+
+
+def _parse_date_fallback(date_str: str):
+    """
+    Разбирает значения, которые не покрывает _DATE_RE.
+
+    Например, компактный ISO ("20251130") или дату без ведущих нулей
+    ("2025-11-1", "2025-1-05 10:00:00"): сначала fromisoformat, затем strptime.
+    """
+    try:
+        if 'T' in date_str or ' ' in date_str:
+            return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        return date.fromisoformat(date_str)
+    except ValueError:
+        pass
+
+    for fmt in _FALLBACK_FORMATS:
+        try:
+            parsed = datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+        # Значение без времени - это весь день, как и у date.fromisoformat
+        return parsed.date() if fmt == "%Y-%m-%d" else parsed
+    raise ValueError(f"Не удалось распарсить дату: {date_str}")
+
+
+@lru_cache(maxsize=512)
+def _build_sql_template(shape: tuple) -> str:
+    """
+    Строит текст SQL запроса по "форме" запроса.
+
+    Параметры нумеруются в том же порядке, в котором их собирает
+    QueryBuilder.build_sql: дата, creator_id, сравнение.
+
+    Args:
+        shape: (table, metric_type, metric_field, date_field, date_mode,
+                has_creator, comparison_field, comparison_op, needs_join)
 
-        # Валидация оператора
-        valid_operators = [">", "<", ">=", "<=", "=", "!="]
-        if operator not in valid_operators:
-            raise ValueError(f"Недопустимый оператор: {operator}")
+    Returns:
+        SQL запрос с плейсхолдерами $1..$N
+    """
+    (table, metric_type, metric_field, date_field, date_mode,
+     has_creator, comparison_field, comparison_op, needs_join) = shape
 
-        where = f"{field} {operator} ${param_index}"
-        params = [value]
+    # Если форма запроса покрывается витриной, читаем из нее
+    mv_sql = _try_route_to_mv(shape)
+    if mv_sql:
+        return mv_sql
+
+    table_name = _TABLE_NAME_MAP[table]
+
+    # Определяем SELECT часть (для JOIN нужно указывать полное имя таблицы)
+    select_table = table_name if needs_join else None
+    select_part = QueryBuilder._build_select(metric_type, metric_field, select_table)
+
+    # Определяем FROM часть (с JOIN если нужно)
+    if needs_join:
+        from_part = f"FROM {table_name} INNER JOIN videos ON {table_name}.video_id = videos.id"
+    else:
+        from_part = f"FROM {table_name}"
+
+    where_parts = []
+    param_index = 1
+
+    # Фильтр по дате
+    if date_mode:
+        # Для JOIN нужно указывать полное имя таблицы
+        field = f"{table_name}.{date_field}" if needs_join else date_field
+        date_where, param_index = QueryBuilder._build_date_filter(field, date_mode, param_index)
+        where_parts.append(date_where)
+
+    # Фильтр по creator_id
+    if needs_join:
+        # Для таблицы snapshots используем JOIN
+        where_parts.append(f"videos.creator_id = ${param_index}")
+        param_index += 1
+    elif has_creator:
+        # Для таблицы videos фильтр по creator_id напрямую
+        where_parts.append(f"creator_id = ${param_index}")
+        param_index += 1
+
+    # Фильтр сравнения
+    if comparison_op:
+        # Для JOIN нужно указывать полное имя таблицы
+        field = f"{table_name}.{comparison_field}" if needs_join else comparison_field
+        where_parts.append(f"{field} {comparison_op} ${param_index}")
+        param_index += 1
+
+    # Собираем WHERE
+    where_part = ""
+    if where_parts:
+        where_part = "WHERE " + " AND ".join(where_parts)
+
+    # Собираем полный запрос
+    return f"{select_part}\n{from_part}\n{where_part}"
+
+
+def _try_route_to_mv(shape: tuple) -> Optional[str]:
+    """
+    Строит запрос к витрине mv_video_daily_agg, если она покрывает форму запроса.
+
+    Подходят COUNT и SUM по итоговым счетчикам таблицы videos без фильтра
+    сравнения, с фильтром по дню публикации (без времени) и/или по creator_id.
+    Порядок параметров совпадает с основным шаблоном: дата, creator_id.
+
+    Returns:
+        SQL запрос или None, если витрина не подходит
+    """
+    (table, metric_type, metric_field, date_field, date_mode,
+     has_creator, comparison_field, comparison_op, needs_join) = shape
+
+    if not _mv_enabled or table != "videos" or comparison_op:
+        return None
+    if date_mode and (date_field != "video_created_at" or date_mode not in _MV_DATE_MODES):
+        return None
+
+    if metric_type == MetricType.COUNT:
+        select_part = "SELECT SUM(n_videos)"
+    elif metric_type == MetricType.SUM and metric_field in _MV_SUM_COLUMNS:
+        select_part = f"SELECT SUM({_MV_SUM_COLUMNS[metric_field]})"
+    else:
+        return None
+
+    where_parts = []
+    param_index = 1
+
+    # Фильтр по дате (в витрине день уже выделен в колонку d)
+    if date_mode in ("exact_date", "range_date"):
+        where_parts.append(f"d >= ${param_index} AND d < ${param_index + 1}")
+        param_index += 2
+    elif date_mode == "start_date":
+        where_parts.append(f"d >= ${param_index}")
+        param_index += 1
+    elif date_mode == "end_date":
+        where_parts.append(f"d < ${param_index}")
         param_index += 1
 
-        return where, params, param_index
+    # Фильтр по creator_id
+    if has_creator:
+        where_parts.append(f"creator_id = ${param_index}")
+        param_index += 1
+
+    where_part = ""
+    if where_parts:
+        where_part = "WHERE " + " AND ".join(where_parts)
+
+    return f"{select_part}\nFROM {_MV_TABLE}\n{where_part}"
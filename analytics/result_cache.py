@@ -0,0 +1,87 @@
+"""
+Кеш результатов аналитических запросов.
+
+Бот возвращает одно агрегированное число, которое меняется медленно
+относительно частоты запросов, поэтому одинаковые QueryRequest в течение
+короткого времени отдаются из памяти без обращения к PostgreSQL.
+"""
+import hashlib
+from datetime import date, datetime
+from time import monotonic
+from typing import Optional
+
+from analytics.query_builder import QueryBuilder
+from bot.config import RESULT_CACHE_TTL
+from nl.schemas import QueryRequest
+
+# Ограничение на количество записей в кеше
+_MAX_ENTRIES = 1024
+
+# Ключ -> (момент истечения по monotonic(), результат)
+_cache: dict[str, tuple[float, int]] = {}
+
+
+def make_key(query: QueryRequest) -> str:
+    """
+    Строит ключ кеша для запроса.
+
+    Порядок полей в JSON pydantic детерминирован (порядок объявления в модели),
+    поэтому одинаковые запросы дают одинаковый ключ.
+    """
+    return hashlib.blake2b(query.model_dump_json().encode(), digest_size=16).hexdigest()
+
+
+def is_cacheable(query: QueryRequest) -> bool:
+    """
+    Проверяет, можно ли кешировать результат запроса.
+
+    Запросы без верхней границы по дате или с границей, захватывающей
+    сегодняшний день, не кешируются: их результат может измениться в любой момент.
+    """
+    date_filter = query.date_filter
+    if not date_filter:
+        return False
+
+    upper = date_filter.exact_date or date_filter.end_date
+    if not upper:
+        return False
+
+    try:
+        upper_obj = QueryBuilder._parse_date_or_datetime(upper)
+    except ValueError:
+        return False
+    if isinstance(upper_obj, datetime):
+        upper_obj = upper_obj.date()
+
+    return upper_obj < date.today()
+
+
+def get(key: str) -> Optional[int]:
+    """Возвращает результат из кеша или None, если записи нет или она устарела."""
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+
+    expires_at, result = entry
+    if expires_at <= monotonic():
+        # Ленивое удаление устаревшей записи
+        del _cache[key]
+        return None
+
+    return result
+
+
+def put(key: str, result: int) -> None:
+    """Сохраняет результат в кеш на RESULT_CACHE_TTL секунд."""
+    if RESULT_CACHE_TTL <= 0:
+        return
+
+    now = monotonic()
+    if len(_cache) >= _MAX_ENTRIES:
+        # Сначала выбрасываем устаревшие записи, затем самые старые
+        for stale_key in [k for k, (expires_at, _) in _cache.items() if expires_at <= now]:
+            del _cache[stale_key]
+        while len(_cache) >= _MAX_ENTRIES:
+            del _cache[next(iter(_cache))]
+
+    _cache[key] = (now + RESULT_CACHE_TTL, result)
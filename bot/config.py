@@ -9,6 +9,18 @@ DATABASE_URL = os.getenv(
     "postgresql://postgres:postgres@db:5432/postgres"
 )
 
+# Пул соединений с БД
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "10"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "50"))
+# Размер кеша prepared statements asyncpg на одно соединение
+DB_STMT_CACHE_SIZE = int(os.getenv("DB_STMT_CACHE_SIZE", "1024"))
+
+# Время жизни кеша результатов запросов к БД (секунды, 0 - отключить)
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "60"))
+
+# Файл SQLite для кеша разобранных запросов между перезапусками (пусто - отключить)
+PARSER_CACHE_PATH = os.getenv("PARSER_CACHE_PATH", "data/parser_cache.sqlite3")
+
 # LLM конфигурация (поддержка разных провайдеров)
 # Режим работы: "ollama" (локально), "deepseek", "openai" или другой
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "deepseek")  # По умолчанию DeepSeek
@@ -41,3 +53,11 @@ else:
     LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.deepseek.com")
     LLM_MODEL = os.getenv("LLM_MODEL", "deepseek-chat")
     LLM_API_KEY = os.getenv("LLM_API_KEY") or DEEPSEEK_API_KEY or OPENAI_API_KEY
+
+# Объединение одновременных запросов к LLM в один (1 - отключено).
+# Запросы разных пользователей попадают в один промпт, поэтому только явно
+LLM_BATCH_MAX = int(os.getenv("LLM_BATCH_MAX", "1"))
+# Сколько ждать остальные запросы пачки после первого (миллисекунды)
+LLM_BATCH_WINDOW_MS = int(os.getenv("LLM_BATCH_WINDOW_MS", "20"))
+# Максимум одновременных запросов к LLM
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
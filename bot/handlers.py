@@ -3,7 +3,8 @@ from aiogram import Router
 from aiogram.types import Message
 
 from nl.parser import get_parser
-from analytics.executor import QueryExecutor
+from analytics import result_cache
+from analytics.executor import QueryExecutor, with_connection
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -19,43 +20,61 @@ async def handle_message(message: Message):
         return
 
     try:
-        logger.info(f"Обработка запроса от пользователя: {user_query}")
+        logger.info("Обработка запроса от пользователя: %s", user_query)
 
         # Получаем парсер
         parser = get_parser()
 
         # Преобразуем естественный язык в структурированный запрос
+        # (типовые формулировки и повторы разбираются без обращения к LLM)
         query_request = await parser.parse_query(user_query)
 
         if not query_request:
-            logger.warning(f"Не удалось распарсить запрос: {user_query}")
+            logger.warning("Не удалось распарсить запрос: %s", user_query)
             await message.answer(
                 "Не удалось обработать запрос. Пожалуйста, попробуйте переформулировать."
             )
             return
 
-        logger.info(f"Запрос распарсен успешно: {query_request}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Запрос распарсен успешно: %s", query_request.model_dump_json())
 
-        # Выполняем запрос к БД
-        result = await QueryExecutor.execute_query(query_request)
+        # Проверяем кеш результатов
+        cache_key = None
+        result = None
+        if result_cache.is_cacheable(query_request):
+            cache_key = result_cache.make_key(query_request)
+            result = result_cache.get(cache_key)
+            if result is not None:
+                logger.info("Результат взят из кеша")
 
         if result is None:
-            await message.answer(
-                "Произошла ошибка при выполнении запроса к базе данных."
-            )
-            return
+            # Выполняем запрос к БД. Соединение закрепляется только на время
+            # работы с БД (не на время запроса к LLM), и все запросы
+            # обработчика идут через него без повторных pool.acquire()
+            async with with_connection():
+                result = await QueryExecutor.execute_query(query_request)
+
+            if result is None:
+                await message.answer(
+                    "Произошла ошибка при выполнении запроса к базе данных."
+                )
+                return
+
+            if cache_key:
+                result_cache.put(cache_key, result)
 
         # Возвращаем результат - одно число
         await message.answer(str(result))
 
     except ValueError as e:
         # Ошибка инициализации парсера (например, нет API ключа)
-        logger.error(f"Ошибка инициализации парсера: {e}")
+        logger.error("Ошибка инициализации парсера: %s", e)
         await message.answer(
             "Ошибка конфигурации бота. Обратитесь к администратору."
         )
     except Exception as e:
-        logger.error(f"Неожиданная ошибка при обработке запроса: {e}", exc_info=True)
+        logger.error("Неожиданная ошибка при обработке запроса: %s", e, exc_info=True)
         await message.answer(
             "Произошла ошибка при обработке вашего запроса. Попробуйте позже."
         )
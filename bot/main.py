@@ -4,6 +4,12 @@ from aiogram import Bot, Dispatcher
 from bot.config import BOT_TOKEN
 from bot.handlers import router
 
+try:
+    # uvloop недоступен на Windows - там остается стандартный цикл событий
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -32,4 +38,6 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    loop_factory = uvloop.new_event_loop if uvloop else None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main())
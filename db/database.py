@@ -1,11 +1,35 @@
 import asyncpg
-from bot.config import DATABASE_URL
+from bot.config import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_STMT_CACHE_SIZE
 
 _pool: asyncpg.Pool | None = None
 
 
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # SUM по bigint (например, по COUNT(*) в витрине) возвращает NUMERIC.
+    # Все агрегаты бота целочисленные, поэтому декодируем NUMERIC сразу в int,
+    # без промежуточного Decimal.
+    await conn.set_type_codec(
+        "numeric",
+        encoder=str,
+        decoder=int,
+        schema="pg_catalog",
+        format="text"
+    )
+
+
 async def get_pool() -> asyncpg.Pool:
     global _pool
     if _pool is None:
-        _pool = await asyncpg.create_pool(DATABASE_URL)
+        # asyncpg подготавливает каждый запрос один раз на соединение и кеширует
+        # prepared statement по тексту SQL. Шаблонов запросов у QueryBuilder
+        # ограниченное число, поэтому кеш делаем заметно больше стандартных 100,
+        # а max_cacheable_statement_size=0 снимает ограничение на размер запроса.
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            statement_cache_size=DB_STMT_CACHE_SIZE,
+            max_cacheable_statement_size=0,
+            init=_init_connection
+        )
     return _pool
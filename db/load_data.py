@@ -1,70 +1,56 @@
 import asyncio
-import json
+import csv
+import io
 import sys
 from pathlib import Path
-from typing import Any
-from datetime import datetime
+from typing import Any, Iterator
 
 import asyncpg
+import ijson
 
 from bot.config import DATABASE_URL
 
 
-VIDEO_INSERT_SQL = """
-INSERT INTO videos (
-    id,
-    creator_id,
-    video_created_at,
-    views_count,
-    likes_count,
-    comments_count,
-    reports_count,
-    created_at,
-    updated_at
-)
-VALUES (
-    $1, $2, $3, $4, $5, $6, $7, $8, $9
-)
-"""
-
-SNAPSHOT_INSERT_SQL = """
-INSERT INTO video_snapshots (
-    id,
-    video_id,
-    views_count,
-    likes_count,
-    comments_count,
-    reports_count,
-    delta_views_count,
-    delta_likes_count,
-    delta_comments_count,
-    delta_reports_count,
-    created_at,
-    updated_at
-)
-VALUES (
-    $1, $2,
-    $3, $4, $5, $6,
-    $7, $8, $9, $10,
-    $11, $12
-)
-"""
-
-
-def parse_datetime(value: str) -> datetime:
+VIDEO_COLUMNS = [
+    "id",
+    "creator_id",
+    "video_created_at",
+    "views_count",
+    "likes_count",
+    "comments_count",
+    "reports_count",
+    "created_at",
+    "updated_at",
+]
+
+SNAPSHOT_COLUMNS = [
+    "id",
+    "video_id",
+    "views_count",
+    "likes_count",
+    "comments_count",
+    "reports_count",
+    "delta_views_count",
+    "delta_likes_count",
+    "delta_comments_count",
+    "delta_reports_count",
+    "created_at",
+    "updated_at",
+]
+
+# Сколько строк накапливать перед отправкой очередного COPY
+BATCH_SIZE = 10_000
+
+
+def iter_videos(path: Path) -> Iterator[dict[str, Any]]:
     """
-    Преобразует ISO-строку из JSON в datetime.
-    JSON содержит строки вида '2025-08-19T08:54:35+00:00'.
+    Потоково читает видео из JSON по одному, не загружая весь файл в память.
     """
-    return datetime.fromisoformat(value)
-
-
-async def load_json(path: Path) -> dict[str, Any]:
     if not path.exists():
         raise FileNotFoundError(f"JSON file not found: {path}")
 
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    with path.open("rb") as f:
+        yield from ijson.items(f, "videos.item")
 
 
 async def clear_tables(conn: asyncpg.Connection) -> None:
@@ -75,78 +61,133 @@ async def clear_tables(conn: asyncpg.Connection) -> None:
     await conn.execute("TRUNCATE video_snapshots, videos CASCADE;")
 
 
+async def refresh_aggregates(conn: asyncpg.Connection) -> None:
+    """
+    Обновление витрины mv_video_daily_agg после загрузки.
+    CONCURRENTLY не блокирует чтение витрины ботом на время обновления.
+    """
+    await conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_video_daily_agg;")
+
+
+def video_row(video: dict[str, Any]) -> tuple:
+    return (
+        video["id"],
+        video["creator_id"],
+        video["video_created_at"],
+        video["views_count"],
+        video["likes_count"],
+        video["comments_count"],
+        video["reports_count"],
+        video["created_at"],
+        video["updated_at"],
+    )
+
+
+def snapshot_row(snapshot: dict[str, Any]) -> tuple:
+    return (
+        snapshot["id"],
+        snapshot["video_id"],
+        snapshot["views_count"],
+        snapshot["likes_count"],
+        snapshot["comments_count"],
+        snapshot["reports_count"],
+        snapshot["delta_views_count"],
+        snapshot["delta_likes_count"],
+        snapshot["delta_comments_count"],
+        snapshot["delta_reports_count"],
+        snapshot["created_at"],
+        snapshot["updated_at"],
+    )
+
+
+def to_csv(rows: list[tuple]) -> io.BytesIO:
+    """
+    Сериализует строки в CSV для текстового COPY.
+    Даты остаются ISO-строками из JSON ('2025-08-19T08:54:35+00:00'),
+    их разбирает PostgreSQL при вставке в TIMESTAMPTZ.
+    """
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return io.BytesIO(buf.getvalue().encode("utf-8"))
+
+
 async def insert_videos(
     conn: asyncpg.Connection,
-    videos: list[dict[str, Any]],
+    rows: list[tuple],
 ) -> None:
-    rows = []
-
-    for video in videos:
-        rows.append(
-            (
-                video["id"],
-                video["creator_id"],
-                parse_datetime(video["video_created_at"]),
-                video["views_count"],
-                video["likes_count"],
-                video["comments_count"],
-                video["reports_count"],
-                parse_datetime(video["created_at"]),
-                parse_datetime(video["updated_at"]),
-            )
-        )
-
-    await conn.executemany(VIDEO_INSERT_SQL, rows)
+    await conn.copy_to_table(
+        "videos",
+        source=to_csv(rows),
+        columns=VIDEO_COLUMNS,
+        format="csv",
+    )
 
 
 async def insert_snapshots(
     conn: asyncpg.Connection,
-    videos: list[dict[str, Any]],
+    rows: list[tuple],
 ) -> None:
-    rows = []
+    await conn.copy_to_table(
+        "video_snapshots",
+        source=to_csv(rows),
+        columns=SNAPSHOT_COLUMNS,
+        format="csv",
+    )
+
+
+async def load_videos(
+    conn: asyncpg.Connection,
+    videos: Iterator[dict[str, Any]],
+) -> int:
+    """
+    Загружает видео и их снапшоты пачками по BATCH_SIZE строк,
+    чтобы пиковое потребление памяти не зависело от размера файла.
+    Видео пачки всегда отправляются раньше ее снапшотов (FK на videos).
+    """
+    video_rows = []
+    snapshot_rows = []
+    total = 0
 
     for video in videos:
+        video_rows.append(video_row(video))
         for snapshot in video.get("snapshots", []):
-            rows.append(
-                (
-                    snapshot["id"],
-                    snapshot["video_id"],
-                    snapshot["views_count"],
-                    snapshot["likes_count"],
-                    snapshot["comments_count"],
-                    snapshot["reports_count"],
-                    snapshot["delta_views_count"],
-                    snapshot["delta_likes_count"],
-                    snapshot["delta_comments_count"],
-                    snapshot["delta_reports_count"],
-                    parse_datetime(snapshot["created_at"]),
-                    parse_datetime(snapshot["updated_at"]),
-                )
-            )
-
-    await conn.executemany(SNAPSHOT_INSERT_SQL, rows)
+            snapshot_rows.append(snapshot_row(snapshot))
+        total += 1
 
+        if len(video_rows) >= BATCH_SIZE or len(snapshot_rows) >= BATCH_SIZE:
+            await insert_videos(conn, video_rows)
+            if snapshot_rows:
+                await insert_snapshots(conn, snapshot_rows)
+            video_rows = []
+            snapshot_rows = []
 
-async def main(json_path: Path) -> None:
-    print(f"Loading data from {json_path}")
+    if video_rows:
+        await insert_videos(conn, video_rows)
+    if snapshot_rows:
+        await insert_snapshots(conn, snapshot_rows)
 
-    data = await load_json(json_path)
-    videos = data.get("videos", [])
+    return total
 
-    if not videos:
-        raise ValueError("JSON does not contain 'videos' or it's empty")
+
+async def main(json_path: Path) -> None:
+    print(f"Loading data from {json_path}")
 
     conn = await asyncpg.connect(DATABASE_URL)
 
     try:
         async with conn.transaction():
             await clear_tables(conn)
-            await insert_videos(conn, videos)
-            await insert_snapshots(conn, videos)
+            loaded = await load_videos(conn, iter_videos(json_path))
+
+            if not loaded:
+                raise ValueError("JSON does not contain 'videos' or it's empty")
+
+        # REFRESH ... CONCURRENTLY нельзя выполнять внутри транзакции
+        await refresh_aggregates(conn)
     finally:
         await conn.close()
 
-    print(f"Loaded {len(videos)} videos successfully")
+    print(f"Loaded {loaded} videos successfully")
 
 
 if __name__ == "__main__":
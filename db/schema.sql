@@ -45,3 +45,25 @@ CREATE INDEX IF NOT EXISTS idx_snapshots_video_id
 
 CREATE INDEX IF NOT EXISTS idx_snapshots_delta_views
     ON video_snapshots (delta_views_count);
+
+-- Предагрегация videos по креатору и дню публикации.
+-- QueryBuilder направляет сюда COUNT/SUM по videos без фильтра сравнения.
+-- Обновляется в db/load_data.py после загрузки данных.
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_video_daily_agg AS
+SELECT
+    creator_id,
+    DATE(video_created_at) AS d,
+    COUNT(*) AS n_videos,
+    SUM(views_count) AS s_views,
+    SUM(likes_count) AS s_likes,
+    SUM(comments_count) AS s_comments,
+    SUM(reports_count) AS s_reports
+FROM videos
+GROUP BY creator_id, DATE(video_created_at);
+
+-- Уникальный индекс нужен для REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_video_daily_agg_creator_d
+    ON mv_video_daily_agg (creator_id, d);
+
+CREATE INDEX IF NOT EXISTS idx_mv_video_daily_agg_d
+    ON mv_video_daily_agg (d);
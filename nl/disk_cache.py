@@ -0,0 +1,114 @@
+"""
+Кеш разобранных запросов на диске (SQLite).
+
+Кеш в памяти парсера пропадает при каждом перезапуске бота, поэтому
+разобранные LLM запросы дополнительно сохраняются в SQLite и переживают
+перезапуск. Обращения к SQLite блокирующие, парсер вызывает их
+через asyncio.to_thread.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from bot.config import PARSER_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+_conn: Optional[sqlite3.Connection] = None
+# Кеш отключается, если базу не удалось открыть (например, нет прав на каталог)
+_disabled = False
+# Соединение одно на процесс, а asyncio.to_thread использует разные потоки
+_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    """Открывает базу кеша и создает таблицу при первом обращении."""
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(PARSER_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = sqlite3.connect(PARSER_CACHE_PATH, isolation_level=None, check_same_thread=False)
+        try:
+            # WAL: чтение не блокируется записью, synchronous=NORMAL достаточно для кеша
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, json TEXT NOT NULL, ts REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_ts ON cache (ts)")
+        except sqlite3.Error:
+            conn.close()
+            raise
+        _conn = conn
+    return _conn
+
+
+def enabled() -> bool:
+    """Включен ли кеш на диске (PARSER_CACHE_PATH не пустой и база открылась)."""
+    return bool(PARSER_CACHE_PATH) and not _disabled
+
+
+def _handle_error(action: str, error: Exception) -> None:
+    """
+    Логирует ошибку кеша; если базу так и не удалось открыть, отключает кеш,
+    чтобы не повторять попытку на каждом сообщении.
+    """
+    global _disabled
+    if _conn is None:
+        _disabled = True
+        logger.warning(
+            "Не удалось открыть кеш парсера на диске (%s), кеш отключен: %s",
+            PARSER_CACHE_PATH, error
+        )
+    else:
+        logger.warning("Ошибка %s кеша парсера на диске: %s", action, error)
+
+
+def get(key: str, ttl: float) -> Optional[str]:
+    """
+    Возвращает сохраненный JSON запроса.
+
+    Args:
+        key: Ключ кеша
+        ttl: Время жизни записи (секунды)
+
+    Returns:
+        JSON QueryRequest или None, если записи нет, она устарела или кеш недоступен
+    """
+    try:
+        with _lock:
+            row = _connect().execute(
+                "SELECT json FROM cache WHERE key = ? AND ts > ?",
+                (key, time.time() - ttl)
+            ).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        _handle_error("чтения", e)
+        return None
+    return row[0] if row else None
+
+
+def put(key: str, value: str, ttl: float) -> None:
+    """
+    Сохраняет JSON запроса и удаляет устаревшие записи.
+
+    Args:
+        key: Ключ кеша
+        value: JSON QueryRequest
+        ttl: Время жизни записей (секунды)
+    """
+    now = time.time()
+    try:
+        with _lock:
+            conn = _connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, json, ts) VALUES (?, ?, ?)",
+                (key, value, now)
+            )
+            conn.execute("DELETE FROM cache WHERE ts <= ?", (now - ttl,))
+    except (sqlite3.Error, OSError) as e:
+        _handle_error("записи", e)
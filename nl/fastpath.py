@@ -0,0 +1,233 @@
+"""
+Быстрый путь разбора типовых запросов без обращения к LLM.
+
+Самые частые формулировки (те же, что перечислены в системном промпте)
+распознаются регулярными выражениями и сразу превращаются в QueryRequest.
+Все остальное по-прежнему разбирает LLM.
+"""
+import logging
+import re
+from datetime import date
+from typing import Callable, Optional
+
+from nl.schemas import (
+    ComparisonFilter,
+    ComparisonOperator,
+    DateFilter,
+    MetricField,
+    MetricType,
+    QueryRequest,
+    TableType,
+)
+
+logger = logging.getLogger(__name__)
+
+# Названия месяцев в родительном падеже ("28 ноября 2025")
+_MONTHS = {
+    "января": 1,
+    "февраля": 2,
+    "марта": 3,
+    "апреля": 4,
+    "мая": 5,
+    "июня": 6,
+    "июля": 7,
+    "августа": 8,
+    "сентября": 9,
+    "октября": 10,
+    "ноября": 11,
+    "декабря": 12,
+}
+
+_MONTH = "(?:" + "|".join(_MONTHS) + ")"
+
+_ISO_DATE = r"\d{4}-\d{2}-\d{2}"
+
+# Дата вида "28 ноября 2025" (слово "года" необязательно) или "2025-11-28"
+_DATE = rf"(?:\d{{1,2}} {_MONTH} \d{{4}}(?: года)?|{_ISO_DATE})"
+
+# Период вида "с 1 ноября 2025 по 5 ноября 2025", "с 1 по 5 ноября 2025"
+# или "с 2025-11-01 по 2025-11-05"
+_RANGE = (
+    rf"с (?P<start>{_ISO_DATE}|\d{{1,2}}(?: {_MONTH}(?: \d{{4}}(?: года)?)?)?)"
+    rf" по (?P<end>{_DATE})(?: включительно)?"
+)
+
+_ISO_DATE_RE = re.compile(_ISO_DATE)
+_DATE_PARTS_RE = re.compile(rf"(\d{{1,2}})(?: ({_MONTH})(?: (\d{{4}}))?)?", re.IGNORECASE)
+
+# Идентификатор креатора (hex, возможно с дефисами, как UUID). Слова вроде
+# "сегодня" сюда не подходят, такие запросы разбирает LLM
+_CREATOR_ID = r"[0-9a-fA-F][0-9a-fA-F-]{7,}"
+
+# Статистика попаданий, чтобы видеть, каких шаблонов не хватает
+_stats = {"hits": 0, "misses": 0}
+
+
+def _normalize(text: str) -> str:
+    """
+    Убирает лишние пробелы и знаки в конце.
+
+    Регистр сохраняется: шаблоны сравниваются без учета регистра,
+    а идентификатор креатора нужно передать в запрос как есть.
+    """
+    text = text.replace("ё", "е").replace("Ё", "Е")
+    text = " ".join(text.split())
+    return text.rstrip(" ?!.")
+
+
+def _parse_date(text: str, default: Optional[date] = None) -> str:
+    """
+    Преобразует дату ("28 ноября 2025" или "2025-11-28") в строку YYYY-MM-DD.
+
+    Месяц и год могут быть опущены ("с 1 по 5 ноября 2025"),
+    тогда они берутся из default.
+    """
+    if _ISO_DATE_RE.fullmatch(text):
+        return date.fromisoformat(text).isoformat()
+
+    day, month, year = _DATE_PARTS_RE.match(text).groups()
+    month_num = _MONTHS[month.lower()] if month else default.month
+    year_num = int(year) if year else default.year
+    return date(year_num, month_num, int(day)).isoformat()
+
+
+def _parse_range(match: re.Match) -> DateFilter:
+    """
+    Строит фильтр по периоду из групп start/end.
+
+    Если у начала периода не указан год и оно получается позже конца
+    ("с 25 декабря по 5 января 2026"), начало относится к предыдущему году.
+    Остальные периоды с началом позже конца отдаются LLM (ValueError).
+    """
+    start_text = match.group("start")
+    end = date.fromisoformat(_parse_date(match.group("end")))
+    start = date.fromisoformat(_parse_date(start_text, default=end))
+    if start > end:
+        parts = None if _ISO_DATE_RE.fullmatch(start_text) else _DATE_PARTS_RE.match(start_text)
+        # Переносим только если месяц указан, а год взят из конца периода
+        if parts is None or not parts.group(2) or parts.group(3):
+            raise ValueError(f"начало периода {start} позже конца {end}")
+        start = start.replace(year=start.year - 1)
+    return DateFilter(
+        field="video_created_at", start_date=start.isoformat(), end_date=end.isoformat()
+    )
+
+
+def _total_videos(match: re.Match) -> QueryRequest:
+    return QueryRequest(table=TableType.VIDEOS, metric_type=MetricType.COUNT)
+
+
+def _creator_videos(match: re.Match) -> QueryRequest:
+    date_filter = _parse_range(match) if match.group("end") else None
+    return QueryRequest(
+        table=TableType.VIDEOS,
+        metric_type=MetricType.COUNT,
+        creator_id_filter=match.group("creator"),
+        date_filter=date_filter,
+    )
+
+
+def _videos_with_views_over(match: re.Match) -> QueryRequest:
+    return QueryRequest(
+        table=TableType.VIDEOS,
+        metric_type=MetricType.COUNT,
+        comparison_filter=ComparisonFilter(
+            field=MetricField.VIEWS,
+            operator=ComparisonOperator.GT,
+            value=int(match.group("value").replace(" ", "")),
+        ),
+    )
+
+
+def _views_growth_on_date(match: re.Match) -> QueryRequest:
+    return QueryRequest(
+        table=TableType.SNAPSHOTS,
+        metric_type=MetricType.SUM,
+        metric_field=MetricField.DELTA_VIEWS,
+        date_filter=DateFilter(field="created_at", exact_date=_parse_date(match.group("date"))),
+    )
+
+
+def _videos_with_new_views_on_date(match: re.Match) -> QueryRequest:
+    return QueryRequest(
+        table=TableType.SNAPSHOTS,
+        metric_type=MetricType.DISTINCT_COUNT,
+        metric_field=MetricField.VIDEO_ID,
+        date_filter=DateFilter(field="created_at", exact_date=_parse_date(match.group("date"))),
+        comparison_filter=ComparisonFilter(
+            field=MetricField.DELTA_VIEWS,
+            operator=ComparisonOperator.GT,
+            value=0,
+        ),
+    )
+
+
+# Шаблоны проверяются по порядку на нормализованном тексте (см. _normalize)
+_PATTERNS: list[tuple[re.Pattern, Callable[[re.Match], QueryRequest]]] = [
+    (
+        re.compile(r"сколько (?:всего )?видео(?: есть)?(?: в системе)?", re.IGNORECASE),
+        _total_videos,
+    ),
+    (
+        re.compile(
+            rf"сколько видео у креатора(?: с id)? (?P<creator>{_CREATOR_ID})"
+            rf"(?: (?:вышло|опубликовано) {_RANGE})?",
+            re.IGNORECASE
+        ),
+        _creator_videos,
+    ),
+    (
+        re.compile(
+            r"сколько видео набрало больше (?P<value>\d[\d ]*?) просмотров(?: за все время)?",
+            re.IGNORECASE
+        ),
+        _videos_with_views_over,
+    ),
+    (
+        re.compile(
+            rf"на сколько просмотров(?: в сумме)? выросли все видео (?P<date>{_DATE})",
+            re.IGNORECASE
+        ),
+        _views_growth_on_date,
+    ),
+    (
+        re.compile(
+            rf"сколько разных видео получали новые просмотры (?P<date>{_DATE})",
+            re.IGNORECASE
+        ),
+        _videos_with_new_views_on_date,
+    ),
+]
+
+
+def try_match(user_query: str) -> Optional[QueryRequest]:
+    """
+    Пытается разобрать запрос по известным шаблонам.
+
+    Args:
+        user_query: Запрос пользователя на русском языке
+
+    Returns:
+        QueryRequest или None, если запрос не подходит ни под один шаблон
+    """
+    text = _normalize(user_query)
+    for pattern, build in _PATTERNS:
+        match = pattern.fullmatch(text)
+        if match:
+            try:
+                query_request = build(match)
+            except ValueError as e:
+                # Например, несуществующая дата - отдаем запрос LLM
+                logger.debug("Быстрый путь не смог построить запрос: %s", e)
+                break
+            _stats["hits"] += 1
+            return query_request
+
+    _stats["misses"] += 1
+    if logger.isEnabledFor(logging.DEBUG):
+        total = _stats["hits"] + _stats["misses"]
+        logger.debug(
+            "Быстрый путь: промах (%d из %d, %.0f%%)",
+            _stats["misses"], total, 100 * _stats["misses"] / total
+        )
+    return None
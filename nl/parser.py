@@ -6,18 +6,54 @@
 - OpenAI API
 - Другие OpenAI-совместимые API
 """
+import asyncio
+import hashlib
 import json
 import logging
-from typing import Optional
-from openai import AsyncOpenAI
+import random
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import cache, partial
+from typing import Callable, Optional
+
+import httpx
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, BadRequestError
 from pydantic import ValidationError
 
-from bot.config import LLM_API_KEY, LLM_BASE_URL, LLM_MODEL, LLM_PROVIDER
-from nl.schemas import QueryRequest
-from nl.prompt import get_system_prompt, get_user_prompt
+from bot.config import (
+    LLM_API_KEY,
+    LLM_BASE_URL,
+    LLM_BATCH_MAX,
+    LLM_BATCH_WINDOW_MS,
+    LLM_MAX_CONCURRENCY,
+    LLM_MODEL,
+    LLM_PROVIDER,
+)
+from nl import disk_cache, fastpath
+from nl.schemas import QueryBatch, QueryRequest
+from nl.prompt import (
+    BATCH_TOOL,
+    QUERY_TOOL,
+    get_batch_user_prompt,
+    get_system_prompt,
+    get_user_prompt,
+)
 
 logger = logging.getLogger(__name__)
 
+# JSON-объект внутри markdown блока ```json ... ```
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(\{.*\})\s*```\s*$", re.DOTALL)
+
+# Время жизни и размер кеша ответов LLM
+CACHE_TTL = 1800
+CACHE_MAX_SIZE = 1000
+
+# Повторы запроса к LLM при временных ошибках: число попыток и предел паузы (секунды)
+RETRY_ATTEMPTS = 4
+RETRY_MAX_DELAY = 10.0
+
 
 class NLParser:
     """Парсер естественного языка для преобразования запросов в структурированный формат."""
@@ -32,13 +68,111 @@ class NLParser:
             model: Модель для использования
             provider: Провайдер ("ollama", "deepseek", "openai" и т.д.)
         """
+        # Один HTTP/2 клиент с keep-alive: одновременные запросы к LLM
+        # мультиплексируются в одном соединении без новых TLS-рукопожатий
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=30.0
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
         self.client = AsyncOpenAI(
             api_key=api_key,
-            base_url=base_url
+            base_url=base_url,
+            http_client=http_client,
+            # Повторы делает _create_completion, чтобы не ждать под блокировкой
+            max_retries=0
         )
         self.model = model
         self.provider = provider
         self.system_prompt = get_system_prompt()
+        # Системное сообщение одинаково для всех запросов; SDK его не изменяет
+        self._system_msg = {"role": "system", "content": self.system_prompt}
+
+        # Поддерживает ли провайдер function calling (None - еще не проверяли).
+        # Ollama может не поддерживать, поэтому для нее сразу просим JSON в промпте
+        self._tools_supported: Optional[bool] = False if provider == "ollama" else None
+        self._tools_probe_lock = asyncio.Lock()
+
+        # Кеш разобранных запросов: ключ -> (QueryRequest, время сохранения)
+        self._cache: OrderedDict[str, tuple[QueryRequest, float]] = OrderedDict()
+        self._ttl = CACHE_TTL
+
+        # Запросы к LLM, которые выполняются прямо сейчас: ключ кеша -> Future
+        self._inflight: dict[str, asyncio.Future] = {}
+
+        # Очередь запросов к LLM для объединения в пачки: (запрос, ключ кеша, Future)
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_worker: Optional[asyncio.Task] = None
+        # Ссылки на выполняющиеся пачки, чтобы задачи не собрал GC
+        self._batch_running: set[asyncio.Task] = set()
+
+        # Ограничение числа одновременных запросов к LLM: при всплеске
+        # лишние запросы ждут очереди, а не открывают сотни соединений
+        self._cond = asyncio.Condition()
+        self._active = 0
+        self._max = LLM_MAX_CONCURRENCY
+
+    def _cache_key(self, user_query: str) -> str:
+        """
+        Строит ключ кеша по модели, системному промпту и нормализованному запросу.
+
+        Нормализуются только пробелы: регистр не меняется, потому что
+        идентификаторы креаторов в запросе чувствительны к регистру.
+        """
+        normalized = " ".join(user_query.split())
+        raw = f"{self.model}|{self.system_prompt}|{normalized}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[QueryRequest]:
+        """Возвращает запрос из кеша, если запись есть и не устарела."""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        query_request, stored_at = entry
+        if time.monotonic() - stored_at >= self._ttl:
+            del self._cache[key]
+            return None
+
+        self._cache.move_to_end(key)
+        return query_request
+
+    def _cache_put(self, key: str, query_request: QueryRequest) -> None:
+        """Сохраняет запрос в кеш, вытесняя самые давно использованные записи."""
+        self._cache[key] = (query_request, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > CACHE_MAX_SIZE:
+            self._cache.popitem(last=False)
+
+    async def _disk_cache_get(self, key: str) -> Optional[QueryRequest]:
+        """Ищет запрос в кеше на диске и при попадании кладет его в кеш в памяти."""
+        if not disk_cache.enabled():
+            return None
+
+        raw = await asyncio.to_thread(disk_cache.get, key, self._ttl)
+        if raw is None:
+            return None
+        try:
+            query_request = QueryRequest.model_validate_json(raw)
+        except ValidationError as e:
+            # Например, запись сохранена до изменения схемы
+            logger.warning("Запись кеша парсера на диске не прошла валидацию: %s", e)
+            return None
+
+        self._cache_put(key, query_request)
+        return query_request
+
+    async def _store(self, key: str, query_request: QueryRequest) -> None:
+        """Сохраняет разобранный запрос в кеш в памяти и на диске."""
+        self._cache_put(key, query_request)
+        if disk_cache.enabled():
+            await asyncio.to_thread(
+                disk_cache.put, key, query_request.model_dump_json(), self._ttl
+            )
 
     async def parse_query(self, user_query: str) -> Optional[QueryRequest]:
         """
@@ -50,101 +184,327 @@ class NLParser:
         Returns:
             QueryRequest или None в случае ошибки
         """
-        content = None
-        json_data = None
+        # Типовые формулировки разбираем шаблонами, без обращения к LLM
+        fast = fastpath.try_match(user_query)
+        if fast is not None:
+            logger.info("Запрос разобран быстрым путем")
+            return fast
+
+        cache_key = self._cache_key(user_query)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.info("Запрос найден в кеше парсера")
+            return cached
+
+        cached = await self._disk_cache_get(cache_key)
+        if cached is not None:
+            logger.info("Запрос найден в кеше парсера на диске")
+            return cached
+
+        # Одинаковые запросы, пришедшие одновременно, ждут один ответ LLM.
+        # Между проверкой и регистрацией нет await, поэтому гонки здесь нет.
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            logger.info("Ожидаем ответ LLM на такой же запрос")
+            # shield: отмена одного ожидающего не должна отменять общий Future
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        query_request = None
         try:
-            logger.info(f"Парсинг запроса: {user_query}")
-            
-            # Для Ollama и некоторых других провайдеров response_format может не поддерживаться
-            # Пробуем с response_format, если не поддерживается - уберем
-            use_json_format = self.provider not in ["ollama"]  # Ollama может не поддерживать
-            
+            if LLM_BATCH_MAX > 1:
+                query_request = await self._submit(user_query, cache_key)
+            else:
+                query_request = await self._parse_with_llm(user_query, cache_key)
+            return query_request
+        finally:
+            del self._inflight[cache_key]
+            if not future.done():
+                future.set_result(query_request)
+
+    async def _submit(self, user_query: str, cache_key: str) -> Optional[QueryRequest]:
+        """
+        Ставит запрос в очередь на разбор пачкой и ждет результат.
+
+        Args:
+            user_query: Запрос пользователя на русском языке
+            cache_key: Ключ кеша для запроса
+
+        Returns:
+            QueryRequest или None в случае ошибки
+        """
+        if self._batch_queue is None:
+            self._batch_queue = asyncio.Queue()
+        if self._batch_worker is None or self._batch_worker.done():
+            self._batch_worker = asyncio.create_task(self._collect_batches())
+
+        future = asyncio.get_running_loop().create_future()
+        self._batch_queue.put_nowait((user_query, cache_key, future))
+        return await future
+
+    async def _collect_batches(self) -> None:
+        """Собирает запросы из очереди в пачки и запускает их разбор."""
+        loop = asyncio.get_running_loop()
+        window = LLM_BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + window
+
+            while len(batch) < LLM_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._parse_batch(batch))
+            self._batch_running.add(task)
+            task.add_done_callback(self._batch_running.discard)
+
+    async def _parse_batch(self, batch: list[tuple[str, str, asyncio.Future]]) -> None:
+        """
+        Разбирает пачку запросов одним обращением к LLM и раздает результаты.
+
+        Запросы, которые не удалось разобрать в пачке, разбираются по одному.
+        """
+        results: list[Optional[QueryRequest]] = [None] * len(batch)
+        if len(batch) > 1:
             try:
-                if use_json_format:
-                    response = await self.client.chat.completions.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "system", "content": self.system_prompt},
-                            {"role": "user", "content": get_user_prompt(user_query)}
-                        ],
-                        temperature=0.1,
-                        response_format={"type": "json_object"}
-                    )
+                results = await self._parse_many([user_query for user_query, _, _ in batch])
+            except Exception as e:
+                logger.warning(
+                    "Не удалось разобрать пачку из %d запросов, разбираем по одному: %s",
+                    len(batch), e
+                )
+
+        async def resolve(item: tuple[str, str, asyncio.Future], query_request) -> None:
+            user_query, cache_key, future = item
+            try:
+                if query_request is None:
+                    query_request = await self._parse_with_llm(user_query, cache_key)
                 else:
-                    # Для Ollama пробуем без response_format, но просим JSON в промпте
-                    response = await self.client.chat.completions.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "system", "content": self.system_prompt},
-                            {"role": "user", "content": get_user_prompt(user_query)}
-                        ],
-                        temperature=0.1
-                    )
-            except Exception as format_error:
-                logger.warning(f"response_format не поддерживается, пробуем без него: {format_error}")
-                # Если response_format не поддерживается, пробуем без него
-                response = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": self.system_prompt},
-                        {"role": "user", "content": get_user_prompt(user_query)}
-                    ],
-                    temperature=0.1
+                    await self._store(cache_key, query_request)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(query_request)
+
+        await asyncio.gather(*(resolve(item, result) for item, result in zip(batch, results)))
+
+    async def _parse_many(self, user_queries: list[str]) -> list[Optional[QueryRequest]]:
+        """
+        Разбирает несколько запросов одним обращением к LLM.
+
+        Args:
+            user_queries: Запросы пользователей на русском языке
+
+        Returns:
+            Список той же длины: QueryRequest или None для запросов,
+            ответ на которые не прошел валидацию
+
+        Raises:
+            ValueError: Если ответ LLM не содержит массива results нужной длины
+        """
+        logger.info("Парсинг пачки из %d запросов", len(user_queries))
+        content = await self._complete(partial(get_batch_user_prompt, user_queries), BATCH_TOOL)
+        logger.info("Ответ от LLM: %s", content)
+
+        # Обычно весь ответ валиден: разбираем JSON и валидируем пачку
+        # за один проход pydantic-core, без промежуточных dict
+        try:
+            results = QueryBatch.model_validate_json(content).results
+        except ValidationError:
+            results = None
+        if results is not None and len(results) == len(user_queries):
+            return results
+
+        # Иначе валидируем каждый элемент отдельно, чтобы ошибка
+        # в одном не отправляла всю пачку на повторный разбор
+        items = json.loads(content).get("results")
+        if not isinstance(items, list) or len(items) != len(user_queries):
+            raise ValueError("в ответе LLM нет массива results нужной длины")
+
+        results = []
+        for user_query, item in zip(user_queries, items):
+            try:
+                results.append(QueryRequest.model_validate(item))
+            except ValidationError as e:
+                logger.warning("Ошибка валидации QueryRequest в пачке (%s): %s", user_query, e)
+                results.append(None)
+        return results
+
+    async def set_max_concurrency(self, max_concurrency: int) -> None:
+        """Меняет предел одновременных запросов к LLM на лету."""
+        async with self._cond:
+            self._max = max_concurrency
+            # При увеличении предела ожидающие сразу проверят его заново
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def _admit(self):
+        """Ждет свободного места среди одновременных запросов к LLM."""
+        async with self._cond:
+            while self._active >= self._max:
+                await self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._active -= 1
+                self._cond.notify(1)
+
+    async def _complete(self, make_prompt: Callable[[bool], str], tool: dict) -> str:
+        """
+        Отправляет запрос в LLM и возвращает JSON из ответа.
+
+        Args:
+            make_prompt: Строит промпт пользователя; аргумент - нужно ли
+                описать формат ответа в тексте (провайдер без function calling)
+            tool: Функция, которую LLM должна вызвать
+
+        Returns:
+            Аргументы вызова функции или текст ответа, очищенный
+            от markdown разметки (может быть пустым)
+        """
+        content, use_tools = await self._create_completion(make_prompt, tool)
+        if use_tools:
+            return content
+
+        # Очищаем ответ от markdown разметки (для Ollama и других моделей)
+        fence_match = _FENCE_RE.match(content)
+        return fence_match.group(1) if fence_match else content
+
+    async def _create_completion(self, make_prompt: Callable[[bool], str], tool: dict):
+        """
+        Отправляет запрос к LLM, повторяя его при временных ошибках:
+        обрыв соединения, таймаут, 408, 409, 429 и 5xx.
+
+        Пауза между попытками растет экспоненциально со случайной добавкой
+        или берется из заголовка Retry-After. Место среди одновременных
+        запросов (_admit) занимается на каждую попытку и освобождается
+        до паузы, поэтому ожидающие повтора не задерживают остальных.
+
+        Returns:
+            Кортеж (JSON из ответа, использован ли function calling)
+        """
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                async with self._admit():
+                    stream, use_tools = await self._try_create_completion(make_prompt, tool)
+                    return await _read_json_object(stream), use_tools
+            except (APIStatusError, APIConnectionError) as e:
+                if not _is_retryable(e) or attempt == RETRY_ATTEMPTS - 1:
+                    raise
+                delay = _retry_delay(e, attempt)
+                logger.warning(
+                    "Временная ошибка LLM API (%s), повтор %d из %d через %.1f с",
+                    getattr(e, "status_code", type(e).__name__),
+                    attempt + 1, RETRY_ATTEMPTS - 1, delay
                 )
+            await asyncio.sleep(delay)
 
-            content = response.choices[0].message.content
-            logger.info(f"Ответ от LLM: {content}")
+    async def _try_create_completion(self, make_prompt: Callable[[bool], str], tool: dict):
+        """
+        Отправляет запрос к LLM, с function calling, если провайдер его поддерживает.
+
+        Поддержка проверяется один раз: первый запрос идет с tools,
+        и если провайдер его отклоняет, все следующие запросы отправляются
+        с описанием формата JSON в промпте. Ошибка 400 может быть вызвана
+        самим сообщением пользователя, поэтому function calling отключается,
+        только если ошибка упоминает tools или тот же запрос без tools проходит.
+        Пока идет проверка, параллельные запросы ждут ее результат,
+        чтобы не делать двойной запрос каждый.
+
+        Returns:
+            Кортеж (потоковый ответ, использован ли function calling)
+        """
+        if self._tools_supported is None:
+            async with self._tools_probe_lock:
+                if self._tools_supported is None:
+                    try:
+                        stream = await self._create(make_prompt(False), tool)
+                    except BadRequestError as tools_error:
+                        stream = None
+                        if "tool" not in str(tools_error).lower():
+                            # Если и без tools запрос отклонен, виновато сообщение:
+                            # ошибка уходит вызывающему, проверка повторится позже
+                            stream = await self._create(make_prompt(True))
+                        logger.warning(
+                            "function calling не поддерживается, дальше запросы без него: %s",
+                            tools_error
+                        )
+                        self._tools_supported = False
+                        if stream is not None:
+                            return stream, False
+                    else:
+                        self._tools_supported = True
+                        return stream, True
+
+        if self._tools_supported:
+            return await self._create(make_prompt(False), tool), True
+        return await self._create(make_prompt(True)), False
+
+    async def _create(self, user_prompt: str, tool: Optional[dict] = None):
+        """Один потоковый запрос chat.completions к LLM."""
+        kwargs = {}
+        if tool is not None:
+            kwargs["tools"] = [tool]
+            kwargs["tool_choice"] = {
+                "type": "function",
+                "function": {"name": tool["function"]["name"]}
+            }
+        return await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                self._system_msg,
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.1,
+            stream=True,
+            **kwargs
+        )
+
+    async def _parse_with_llm(self, user_query: str, cache_key: str) -> Optional[QueryRequest]:
+        """
+        Разбирает запрос через LLM и сохраняет успешный результат в кеш.
+
+        Args:
+            user_query: Запрос пользователя на русском языке
+            cache_key: Ключ кеша для запроса
+
+        Returns:
+            QueryRequest или None в случае ошибки
+        """
+        content = None
+        try:
+            logger.info("Парсинг запроса: %s", user_query)
+            
+            content = await self._complete(partial(get_user_prompt, user_query), QUERY_TOOL)
+            logger.info("Ответ от LLM: %s", content)
             
             if not content:
                 logger.error("Пустой ответ от LLM")
                 return None
 
-            # Очищаем ответ от markdown разметки (для Ollama и других моделей)
-            content_clean = content.strip()
-            # Убираем markdown блоки ```json ... ```
-            if content_clean.startswith("```"):
-                # Находим начало и конец JSON
-                start = content_clean.find("{")
-                end = content_clean.rfind("}") + 1
-                if start != -1 and end > start:
-                    content_clean = content_clean[start:end]
-                else:
-                    # Если не нашли, пробуем убрать только обратные кавычки
-                    content_clean = content_clean.replace("```json", "").replace("```", "").strip()
-            
-            # Парсим JSON ответ
-            json_data = json.loads(content_clean)
-            logger.info(f"Распарсенный JSON: {json_data}")
-
-            # Нормализуем название таблицы (LLM может вернуть "video_snapshots" вместо "snapshots")
-            if json_data.get("table") == "video_snapshots":
-                json_data["table"] = "snapshots"
-                logger.info("Нормализовано: video_snapshots → snapshots")
-            
-            # Нормализуем metric_field для подсчета уникальных дат
-            if json_data.get("metric_field"):
-                metric_field = json_data["metric_field"]
-                if "video_created_at" in metric_field and "date" in metric_field.lower():
-                    json_data["metric_field"] = "video_created_at_date"
-                    logger.info("Нормализовано: video_created_at::date → video_created_at_date")
-                elif "created_at" in metric_field and "date" in metric_field.lower():
-                    json_data["metric_field"] = "created_at_date"
-                    logger.info("Нормализовано: created_at::date → created_at_date")
-
-            # Валидируем через Pydantic
-            query_request = QueryRequest(**json_data)
-            logger.info(f"Валидация успешна: table={query_request.table.value}, metric_type={query_request.metric_type.value}, "
-                       f"creator_id_filter={query_request.creator_id_filter}, "
-                       f"date_filter={query_request.date_filter}")
-            return query_request
+            # Разбираем JSON и валидируем за один проход (нормализация значений
+            # от LLM выполняется валидаторами QueryRequest)
+            query_request = QueryRequest.model_validate_json(content)
+            logger.info(
+                "Валидация успешна: table=%s, metric_type=%s, creator_id_filter=%s, date_filter=%s",
+                query_request.table.value, query_request.metric_type.value,
+                query_request.creator_id_filter, query_request.date_filter
+            )
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка парсинга JSON от LLM: {e}")
-            logger.error(f"Ответ LLM: {content}")
-            return None
         except ValidationError as e:
-            logger.error(f"Ошибка валидации QueryRequest: {e}")
-            logger.error(f"JSON от LLM: {json_data}")
+            # Сюда попадает и невалидный JSON (тип ошибки json_invalid)
+            logger.error("Ошибка валидации QueryRequest: %s", e)
+            logger.error("Ответ LLM: %s", content)
             return None
         except Exception as e:
             error_type = type(e).__name__
@@ -152,46 +512,142 @@ class NLParser:
             
             # Специальная обработка ошибок API
             if "APIStatusError" in error_type or "402" in error_msg or "Insufficient Balance" in error_msg:
-                logger.error(f"Недостаточно баланса на DeepSeek API: {error_msg}")
+                logger.error("Недостаточно баланса на DeepSeek API: %s", error_msg)
                 logger.error("Пожалуйста, пополните баланс на https://platform.deepseek.com")
             elif "401" in error_msg or "Invalid API Key" in error_msg or "Unauthorized" in error_msg:
-                logger.error(f"Неверный API ключ DeepSeek: {error_msg}")
+                logger.error("Неверный API ключ DeepSeek: %s", error_msg)
             elif "429" in error_msg or "Rate limit" in error_msg:
-                logger.error(f"Превышен лимит запросов к DeepSeek API: {error_msg}")
+                logger.error("Превышен лимит запросов к DeepSeek API: %s", error_msg)
             else:
-                logger.error(f"Ошибка при обращении к LLM API: {error_type}: {error_msg}")
-                import traceback
-                logger.error(traceback.format_exc())
+                # logger.exception добавляет traceback при форматировании записи
+                logger.exception("Ошибка при обращении к LLM API: %s: %s", error_type, error_msg)
             
             return None
 
+        # Сохраняем вне try: ошибка кеша не должна отменять успешный разбор
+        await self._store(cache_key, query_request)
+        return query_request
+
+
+def _is_retryable(error: Exception) -> bool:
+    """
+    Временная ошибка, после которой запрос стоит повторить.
+
+    Те же случаи, что повторяет сам SDK: обрыв соединения и таймаут
+    (APITimeoutError - подкласс APIConnectionError), 408, 409, 429 и 5xx.
+    """
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
 
-# Глобальный экземпляр парсера (будет инициализирован при старте бота)
-_parser: Optional[NLParser] = None
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Пауза перед следующей попыткой.
 
+    Args:
+        error: Ошибка предыдущей попытки
+        attempt: Номер предыдущей попытки, начиная с 0
 
+    Returns:
+        Значение Retry-After, если провайдер его прислал,
+        иначе 2^attempt секунд со случайной добавкой (не больше RETRY_MAX_DELAY)
+    """
+    retry_after = None
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            # Retry-After в виде HTTP-даты не разбираем
+            pass
+    return min(2 ** attempt + random.random(), RETRY_MAX_DELAY)
+
+
+async def _read_json_object(stream) -> str:
+    """
+    Читает потоковый ответ LLM до конца первого JSON-объекта.
+
+    Читаются аргументы вызова функции или, без function calling, текст ответа.
+    Как только закрывается внешняя фигурная скобка, чтение прекращается:
+    хвост ответа (пробелы, закрывающий ```, пояснения модели) не ждем.
+
+    Args:
+        stream: Потоковый ответ chat.completions (stream=True)
+
+    Returns:
+        Текст JSON-объекта или весь ответ, если объект так и не закрылся
+    """
+    chunks = []
+    received = 0
+    start = None
+    depth = 0
+    in_str = False
+    esc = False
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            # Аргументы вызова функции или обычный текст ответа
+            delta = chunk.choices[0].delta
+            if delta.tool_calls:
+                function = delta.tool_calls[0].function
+                text = function.arguments or "" if function else ""
+            else:
+                text = delta.content or ""
+            chunks.append(text)
+
+            for i, ch in enumerate(text):
+                if in_str:
+                    if esc:
+                        esc = False
+                    elif ch == "\\":
+                        esc = True
+                    elif ch == '"':
+                        in_str = False
+                elif ch == '"':
+                    if start is not None:
+                        in_str = True
+                elif ch == "{":
+                    if start is None:
+                        start = received + i
+                    depth += 1
+                elif ch == "}" and start is not None:
+                    depth -= 1
+                    if depth == 0:
+                        chunks[-1] = text[:i + 1]
+                        return "".join(chunks)[start:]
+            received += len(text)
+    finally:
+        # Закрываем поток, чтобы не дочитывать ответ в фоне
+        await stream.close()
+
+    return "".join(chunks)
+
+
+@cache
 def get_parser() -> NLParser:
-    """Возвращает глобальный экземпляр парсера."""
-    global _parser
-    if _parser is None:
-        if not LLM_API_KEY and LLM_PROVIDER != "ollama":
-            raise ValueError(
-                f"LLM_API_KEY не установлен для провайдера {LLM_PROVIDER}. "
-                f"Установите переменную окружения или используйте LLM_PROVIDER=ollama"
-            )
-        
-        # Для Ollama ключ не обязателен, но SDK требует его наличие
-        api_key = LLM_API_KEY if LLM_API_KEY else "ollama"
-        
-        logger.info(
-            f"Инициализация парсера: провайдер={LLM_PROVIDER}, "
-            f"модель={LLM_MODEL}, base_url={LLM_BASE_URL}"
-        )
-        
-        _parser = NLParser(
-            api_key=api_key,
-            base_url=LLM_BASE_URL,
-            model=LLM_MODEL,
-            provider=LLM_PROVIDER
+    """Возвращает глобальный экземпляр парсера (создается при первом вызове)."""
+    if not LLM_API_KEY and LLM_PROVIDER != "ollama":
+        raise ValueError(
+            f"LLM_API_KEY не установлен для провайдера {LLM_PROVIDER}. "
+            f"Установите переменную окружения или используйте LLM_PROVIDER=ollama"
         )
-    return _parser
+
+    # Для Ollama ключ не обязателен, но SDK требует его наличие
+    api_key = LLM_API_KEY if LLM_API_KEY else "ollama"
+
+    logger.info(
+        "Инициализация парсера: провайдер=%s, модель=%s, base_url=%s",
+        LLM_PROVIDER, LLM_MODEL, LLM_BASE_URL
+    )
+
+    return NLParser(
+        api_key=api_key,
+        base_url=LLM_BASE_URL,
+        model=LLM_MODEL,
+        provider=LLM_PROVIDER
+    )
@@ -3,7 +3,7 @@
 """
 from enum import Enum
 from typing import Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 
 
 class TableType(str, Enum):
@@ -36,6 +36,16 @@ class MetricField(str, Enum):
     CREATED_AT_DATE = "created_at_date"  # Для COUNT(DISTINCT DATE(created_at))
 
 
+class ComparisonOperator(str, Enum):
+    """Оператор сравнения."""
+    GT = ">"
+    LT = "<"
+    GTE = ">="
+    LTE = "<="
+    EQ = "="
+    NEQ = "!="
+
+
 class DateFilter(BaseModel):
     """Фильтр по дате."""
     field: str = Field(description="Поле для фильтрации (video_created_at или created_at)")
@@ -47,7 +57,7 @@ class DateFilter(BaseModel):
 class ComparisonFilter(BaseModel):
     """Фильтр сравнения."""
     field: MetricField = Field(description="Поле для сравнения")
-    operator: str = Field(description="Оператор: >, <, >=, <=, =")
+    operator: ComparisonOperator = Field(description="Оператор: >, <, >=, <=, =, !=")
     value: int = Field(description="Значение для сравнения")
 
 
@@ -65,6 +75,25 @@ class QueryRequest(BaseModel):
     # Для запросов по приросту (delta)
     use_delta: bool = Field(False, description="Использовать приращения (delta_*) вместо абсолютных значений")
 
+    @field_validator("table", mode="before")
+    @classmethod
+    def _normalize_table(cls, value):
+        """LLM может вернуть "video_snapshots" вместо "snapshots"."""
+        if value == "video_snapshots":
+            return TableType.SNAPSHOTS.value
+        return value
+
+    @field_validator("metric_field", mode="before")
+    @classmethod
+    def _normalize_metric_field(cls, value):
+        """Приводит варианты вроде "video_created_at::date" к полям подсчета уникальных дат."""
+        if isinstance(value, str) and "date" in value.lower():
+            if "video_created_at" in value:
+                return MetricField.VIDEO_CREATED_AT_DATE.value
+            if "created_at" in value:
+                return MetricField.CREATED_AT_DATE.value
+        return value
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -80,6 +109,11 @@ class QueryRequest(BaseModel):
         }
 
 
+class QueryBatch(BaseModel):
+    """Ответ LLM на пачку запросов."""
+    results: list[QueryRequest] = Field(description="Запросы в том же порядке, что и вопросы")
+
+
 # Описание схемы БД для промпта
 DATABASE_SCHEMA = """
 База данных содержит две таблицы: